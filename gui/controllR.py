@@ -2,7 +2,7 @@ import os
 from operator import attrgetter
 from PyQt4 import QtGui, QtCore
 
-from ovsylib.aggressive_threading import Broker
+from ovsylib.extraction import Extractor, plan
 
 
 class CustomThread(QtCore.QThread):
@@ -30,11 +30,6 @@ class CustomThread(QtCore.QThread):
         self.emit(QtCore.SIGNAL("errormsg"), message)
 
 
-def extractJob(pac, fid, destdir, filename):
-    with open(filename, "rb") as binfile:
-        pac.extract_file_id(fid, destdir, binfile, debuggy=False)
-
-
 class GeoFront:
     def __init__(self, app):
         self.app = app
@@ -76,18 +71,18 @@ class GeoFront:
         if self.can_start():
             self.opname = ["extract package", "extracting"]
             def capsule(thread):
-                threads = Broker(len(self.app.staging.package.files))
-                thread.abort_interface = threads
                 fids = self.app.staging.package.search_file(internalname, exact_match=False)
-                for fid in fids:
+                extractor = Extractor(self.app.staging.package, self.app.staging.target, saveto,
+                                      max_needed_threads=len(fids))
+                thread.abort_interface = extractor
+                for job in plan(self.app.staging.package, fids):
                     if thread.handbrake:
                         break
-                    if not threads.appendNfire(extractJob,
-                                        (self.app.staging.package,
-                                         fid, saveto, self.app.staging.target)):
+                    if not extractor.submit(job):
                         break
-                    thread.progressCallback(self.app.staging.package.get_file_by_id(fid))
-                threads.stop()
+                    for fid in job:
+                        thread.progressCallback(self.app.staging.package.get_file_by_id(fid))
+                extractor.stop()
                 self.after_run(thread, "done %s %d files" % (self.opname[1], self.doneunits))
             self.worker.target = capsule
             fids = self.app.staging.package.search_file(internalname, exact_match=False)
@@ -114,7 +109,7 @@ class GeoFront:
                 self.app.staging.writeout(destination, progresscback=thread.progressCallback, abort=chkabrt)
                 if not thread.handbrake:
                     self.unsaved = False
-                self.app.staging.target = destination
+                self.app.staging.written(destination)
                 self.after_run(thread, "done %s %d files" % (self.opname[1], self.doneunits))
             self.worker.target = capsule
             self.numunits = len(self.app.staging.package.files)
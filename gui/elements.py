@@ -43,6 +43,10 @@ def setToolbar(object):
     writecall.setStatusTip("Write modifies to disk")
     object.connect(writecall, QtCore.SIGNAL('triggered()'), object.writeTo)
 
+    workers = QtGui.QAction(QtGui.QIcon.fromTheme("preferences-system"), "Workers", object)
+    workers.setStatusTip("Choose how many workers to use, and how to run them")
+    object.connect(workers, QtCore.SIGNAL('triggered()'), object.setupWorkers)
+
     object.top_toolbar = object.addToolBar('Main toolbar')
     object.top_toolbar.addAction(createf)
     object.top_toolbar.addAction(openf)
@@ -50,6 +54,7 @@ def setToolbar(object):
     object.top_toolbar.addAction(commitcall)
     object.top_toolbar.addAction(writecall)
     object.top_toolbar.addAction(abrt)
+    object.top_toolbar.addAction(workers)
     object.top_toolbar.addAction(info)
     object.top_toolbar.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
 
@@ -2,7 +2,7 @@ from PyQt4 import QtGui, QtCore
 import os, sys
 
 from gui import elements, adapter, controllR
-from ovsylib import datastruct, fileadding_utils, info
+from ovsylib import datastruct, fileadding_utils, info, aggressive_threading
 
 class MainWindow(QtGui.QMainWindow):
     def __init__(self, title="MasterBlade Neptune"):
@@ -223,6 +223,17 @@ class MainWindow(QtGui.QMainWindow):
         else:
             self.errorbox("Please load or create a .pac archive first")
 
+    def setupWorkers(self):
+        executors = aggressive_threading.executors
+        executor, ok = QtGui.QInputDialog.getItem(self, "Workers", "Run the workers as:", executors,
+                                                  executors.index(aggressive_threading.settings["executor"]), False)
+        if not ok:
+            return
+        jobs, ok = QtGui.QInputDialog.getInt(self, "Workers", "Number of workers:",
+                                             aggressive_threading.getMaxThreads(), 1, 256)
+        if ok:
+            aggressive_threading.configure(executor=str(executor), jobs=jobs)
+
     def errorbox(self, message):
         QtGui.QMessageBox.information(self, "Error!", message)
 
@@ -1,28 +1,27 @@
 #!/usr/bin/python
 
-from ovsylib import cliparse, datastruct, fileadding_utils, info
-from ovsylib.aggressive_threading import Broker
+from ovsylib import cliparse, datastruct, datamover, fileadding_utils, info, pacindex, aggressive_threading
+from ovsylib.extraction import Extractor, plan
 from gui import mainview
 import os,sys
 
 
-def extractJob(pac, fid, cmdline, filename):
-    with open(filename, "rb") as binfile:
-        pac.extract_file_id(fid, cmdline.extract, binfile, debuggy=cmdline.debug)
-
-
 def nonStaging(pac, cmdline, filename):
     if cmdline.list:
         pac.print_info()
     elif cmdline.list_harder:
+        with datamover.open_binfile(filename, mapped=cmdline.mmap) as binfile:
+            pac.load_compression_info(binfile)
         pac.print_detailed_info()
     elif cmdline.file_info:
         file = pac.get_file_by_id(cmdline.file_info)
         if file is not None:
+            with datamover.open_binfile(filename, mapped=cmdline.mmap) as binfile:
+                file.need_compression_info(binfile)
             print("          id    offset       size  compress  size  filename")
             file.print_detailed_info()
     elif cmdline.extract_id:
-        with open(filename, "rb") as binfile:
+        with datamover.open_binfile(filename, mapped=cmdline.mmap) as binfile:
             idlist = map(int, cmdline.extract_id.split(","))
             if cmdline.raw:
                 location = datastruct.adjust_separator_for_fs("raw-extract/")
@@ -35,17 +34,19 @@ def nonStaging(pac, cmdline, filename):
                 if cmdline.extract:
                     location = cmdline.extract
                 for fid in idlist:
-                    pac.extract_file_id(fid, location, binfile, debuggy=cmdline.debug)
+                    pac.extract_file_id(fid, location, binfile, debuggy=cmdline.debug,
+                                        parallel=cmdline.parallel_chunks)
 
     elif cmdline.extract:
-        threads = Broker(len(pac.files))
-        for fid in pac.list_file_ids():
-            threads.appendNfire(extractJob, (pac, fid, cmdline, filename))
-        threads.stop()
+        extractor = Extractor(pac, filename, cmdline.extract, mapped=cmdline.mmap, debuggy=cmdline.debug)
+        for job in plan(pac, pac.list_file_ids(), policy=cmdline.extract_order):
+            extractor.submit(job)
+        extractor.stop()
         print("Extraction job completed")
 
 def cliUI(cmdline):
-    sekai = fileadding_utils.staging()
+    aggressive_threading.configure(executor=cmdline.executor, jobs=cmdline.jobs)
+    sekai = fileadding_utils.staging(journaled=True)
     docompress = not cmdline.no_compress
     dryrun = cmdline.dry_run
     # staging operations
@@ -111,8 +112,11 @@ def cliUI(cmdline):
     # non-staging operations
     elif cmdline.file is not None:
         pac = datastruct.Pacfile()
-        with open(cmdline.file, "rb") as binfile:
-            pac.load_from_file(binfile)
+        with datamover.open_binfile(cmdline.file, mapped=cmdline.mmap) as binfile:
+            if cmdline.index:
+                pacindex.load(pac, binfile, cmdline.file, eager=cmdline.list_harder)
+            else:
+                pac.load_from_file(binfile, eager=cmdline.list_harder)
         nonStaging(pac, cmdline, cmdline.file)
 
     else:
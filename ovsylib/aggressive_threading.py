@@ -1,65 +1,204 @@
-from multiprocessing import Pool, Manager, cpu_count
-from queue import Queue
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from queue import Queue, Empty, Full
+from threading import Semaphore, Thread, Event
 import math
+import os
 
 
 """
     Handles parallel computations;
-    multiprocessing is used to work around the GIL limitations in python
+    multiprocessing is used to work around the GIL limitations in python.
+    The jobs can also be run on threads (cheap to start, no pickling) or serially (debugging),
+    see configure()
 """
 
 
+executors = ["process", "thread", "serial"]
+settings = {"executor": "process", "jobs": None}
+
+
+def configure(executor=None, jobs=None):
+    """
+    Set the defaults for the Brokers created from now on
+    :param executor: one of executors
+    :param jobs: number of workers, None means one per available cpu
+    """
+    if executor is not None:
+        if executor not in executors:
+            raise ValueError("unknown executor: %s" % executor)
+        settings["executor"] = executor
+    if jobs is not None and jobs < 1:
+        raise ValueError("the number of workers must be at least 1, not %d" % jobs)
+    settings["jobs"] = jobs
+
+
+def cpu_quota():
+    """ :return: cpus granted by the cgroup cpu quota (i.e. containers), None if unlimited """
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as quotafile:  # cgroup v2
+            quota, period = quotafile.read().split()[:2]
+        if quota == "max":
+            return None
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quotafile:  # cgroup v1
+            quota = int(quotafile.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as periodfile:
+            period = int(periodfile.read())
+        if quota <= 0:
+            return None
+        return max(1, math.ceil(quota / period))
+    except (OSError, ValueError):
+        return None
+
+
+def getAvailableCpus():
+    """ cpu_count(), reduced to the cpus this process may run on, and to the cgroup quota """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on every platform
+        cpus = cpu_count()
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, quota)
+    return cpus
+
+
 def getMaxThreads():
-    return cpu_count()
+    if settings["jobs"] is not None:
+        return settings["jobs"]
+    return getAvailableCpus()
+
+
+class SerialResult:
+
+    """ same interface as multiprocessing's AsyncResult, for a function already run """
+
+    def __init__(self, value, success):
+        self.value = value
+        self.success = success
+
+    def ready(self):
+        return True
+
+    def get(self, timeout=None):
+        if not self.success:
+            raise self.value
+        return self.value
+
+
+class SerialPool:
+
+    """ same interface as multiprocessing's Pool, the functions are run right away by the caller """
+
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        self.running = True
+        if initializer is not None:
+            initializer(*initargs)
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        if not self.running:
+            raise ValueError("Pool not running")
+        try:
+            res = SerialResult(func(*args), True)
+        except Exception as e:
+            res = SerialResult(e, False)
+            if error_callback is not None:
+                error_callback(e)
+            return res
+        if callback is not None:
+            callback(res.value)
+        return res
+
+    def close(self):
+        self.running = False
+
+    def join(self):
+        pass
 
+    def terminate(self):
+        self.running = False
 
-def worker(func, args, sem):
-    ret = func(*args)
-    sem.release()
-    return ret
+
+pools = {"process": Pool, "thread": ThreadPool, "serial": SerialPool}
 
 
 class Broker:
 
-    def __init__(self, max_needed_threads, greed=1, debugmode=False):
+    def __init__(self, max_needed_threads, greed=1, debugmode=False, lookahead=None, initializer=None, initargs=(),
+                 executor=None):
         """
         :param max_needed_threads: exactly what is says, to avoid wasting resources
-        :param greed: multiplied with cpu_count(), gives the number of spawned subprocesses
+        :param greed: multiplied with getMaxThreads(), gives the number of workers
         :param debugmode:
+        :param lookahead: if set, max number of launched functions whose result was not collected yet
+        :param initializer: if set, each worker runs initializer(*initargs) when it starts
+        :param executor: one of executors, defaults to the configured one (see configure)
         """
+        if executor is None:
+            executor = settings["executor"]
         self.debugmode = debugmode
-        self.maxthreads = min(math.ceil(getMaxThreads() * greed), max_needed_threads)
+        self.executor = executor
+        self.maxthreads = max(1, min(math.ceil(getMaxThreads() * greed), max_needed_threads))
         self.threadcontrol = Queue()
-        self.pool = Pool(processes=self.maxthreads)
+        self.pool = pools[executor](processes=self.maxthreads, initializer=initializer, initargs=initargs)
         self.unid = 0
-        self.freespots = Manager().Semaphore(self.maxthreads)
+        # max number of functions launched but not completed yet: enough to keep the workers fed
+        self.freespots = Semaphore(self.maxthreads * 2)
+        self.window = None
+        if lookahead is not None:
+            self.window = Semaphore(lookahead)
+
+    def _completed(self, result):
+        """ called (in the parent process) whenever a launched function returns or raises """
+        self.freespots.release()
 
     def appendNfire(self, func, args):
-        """ launch (runs in a subprocess) a function func, with arguments specified in the tuple args.
+        """ launch (runs in a worker) a function func, with arguments specified in the tuple args.
          :returns true upon success """
+        if self.window is not None:
+            self.window.acquire()
         try:
             self.freespots.acquire()
             assert isinstance(args, tuple)
             if self.debugmode:
                 print("Spawning thread #%d" % self.unid)
-            r = self.pool.apply_async(worker, [func, args, self.freespots])
+            r = self.pool.apply_async(func, args, callback=self._completed, error_callback=self._completed)
             self.threadcontrol.put((self.unid, r))
             self.unid += 1
             return True
         except ValueError:
             self.freespots.release()
+            if self.window is not None:
+                self.window.release()
             return False
 
     def collect(self):
         """ generator of the launched functions' results, yields them in the same order as
          the function launching order """
         while not self.threadcontrol.empty():
-            cnt = self.threadcontrol.get()
-            r = cnt[1]
-            res = r.get()
-            if self.debugmode:
-                print("Collecting thread #%d" % cnt[0])
-            yield res
+            yield self.collect_one()
+
+    def collect_one(self, timeout=None):
+        """ :return: the result of the oldest launched function not collected yet; if there is none,
+         wait for one to be launched (raises queue.Empty after timeout seconds, if specified) """
+        cnt = self.threadcontrol.get(timeout=timeout)
+        if self.window is not None:
+            self.window.release()
+        res = cnt[1].get()
+        if self.debugmode:
+            print("Collecting thread #%d" % cnt[0])
+        return res
+
+    def discard(self):
+        """ forget about the results not collected yet (the functions keep running) """
+        while not self.threadcontrol.empty():
+            self.threadcontrol.get()
+            if self.window is not None:
+                self.window.release()
 
     def stop(self):
         """ closes the subthreads """
@@ -70,4 +209,56 @@ class Broker:
         """ kills the subthreads with fire """
         self.freespots.release()  # this will release a stuck appendNfire()
         self.pool.terminate()
-        self.pool.join()
\ No newline at end of file
+        self.pool.join()
+
+
+class Prefetcher:
+
+    """
+    Collects a known number of results from a Broker in a background thread, so that the
+    workers are kept busy while the consumer is doing something else (i.e. disk I/O);
+    up to maxsize results are buffered. Exposes the same collect_one() as the Broker
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, broker, count, maxsize):
+        self.broker = broker
+        self.count = count
+        self.results = Queue(maxsize)
+        self.stopped = Event()
+        self.thread = Thread(target=self._run)
+        self.thread.start()
+
+    def _run(self):
+        for i in range(self.count):
+            item = None
+            while item is None:
+                if self.stopped.is_set():
+                    return
+                try:
+                    item = (True, self.broker.collect_one(timeout=self.poll_interval))
+                except Empty:
+                    pass
+                except Exception as e:  # will be raised again on the consumer's side
+                    item = (False, e)
+            while True:
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.results.put(item, timeout=self.poll_interval)
+                    break
+                except Full:
+                    pass
+            if not item[0]:
+                return
+
+    def collect_one(self):
+        success, res = self.results.get()
+        if not success:
+            raise res
+        return res
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
@@ -1,5 +1,14 @@
 import argparse
 
+from ovsylib import aggressive_threading
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
 
 def parsecli():
     parser = argparse.ArgumentParser(description="Hyperdimension Neptunia .pac packer / unpacker")
@@ -10,6 +19,23 @@ def parsecli():
                         ' If single files are not specified, extract the whole package', type=str)
     parser.add_argument('--list-harder', '-L', help='list in detail the content of the file', action='store_true')
     parser.add_argument('--extract-id', metavar='id,list', help='extract files specified by id', type=str)
+    parser.add_argument('--extract-order', help='order of the whole-package extraction: largest files first (keeps'
+                        ' all the workers busy), by offset inside the .pac (sequential reads) or in directory'
+                        ' order; small files are extracted in batches', choices=['largest', 'offset', 'directory'],
+                        default='largest')
+    parser.add_argument('--jobs', '-j', metavar='N', help='number of workers used to (de)compress and extract;'
+                        ' defaults to the available cpus (cgroup quota aware)', type=positive_int)
+    parser.add_argument('--executor', help='run the workers as processes (default), threads, or serially in the'
+                        ' main thread (useful for debugging)', choices=aggressive_threading.executors,
+                        default=aggressive_threading.settings["executor"])
+    parser.add_argument('--parallel-chunks', help='when extracting files by id, decompress the chunks of each file'
+                        ' in parallel; useful for few, large files', action='store_true')
+    parser.add_argument('--mmap', help='memory-map the .pac file instead of reading it (non-staging and peek'
+                        ' operations)', action='store_true')
+    parser.add_argument('--index', help='(non-staging) keep a sidecar index (<filename>.ovsidx) of the directory'
+                        ' and compression headers next to the .pac, making the next opens faster; it is rebuilt'
+                        ' automatically when the .pac changes; building it reads the compression header of every'
+                        ' compressed file once, so that first open is slower', action='store_true')
     parser.add_argument('--file-info', metavar='id', help='print detailed information about a specific file', type=int)
     parser.add_argument('--dry-run', '-D', help='Applies to packing, not unpacking; do everything, create files/'
                         'directories, except nothing is actually written', action='store_true')
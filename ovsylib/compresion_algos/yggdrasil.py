@@ -1,6 +1,8 @@
 import bitarray
-import struct
+import array
 import math
+import heapq
+from collections import Counter
 
 """
 compression algorithm based on the following structure:
@@ -52,79 +54,80 @@ class TreeNode:
         self.childzero = None   # if I'm ever having children, I'll name them like this
         self.childone = None
         self.isleaf = False     # to let the algorithm know when to stop
-        self.isActive = True    # active node: a subtree can be attached here
         self.value = b"\0"       # value (a single byte)
 
     def set_value(self, value):
-        self.isActive = False
         self.isleaf = True
         self.value = value
 
-    def expand_node(self):
-        """ append a left (zero) and right (one) child, left is returned """
-        return self.bilateral_expand()[0]
-
-    def bilateral_expand(self):
-        """ append a left (zero) and right (one) child, return a list containing both """
-        self.isActive = False
-        self.isleaf = False
-        self.childzero = TreeNode()
-        self.childone = TreeNode()
-        return [self.childzero, self.childone]
-
-    def find_first_active(self):
-        """ recursive depth-first search for the leftmost active node """
-        if self.isleaf:
-            return None
-        if self.isActive:
-            return self
-        if self.childzero.isActive:
-            return self.childzero
-        deepleft = self.childzero.find_first_active()
-        if deepleft is not None:
-            return deepleft
-        if self.childone.isActive:
-            return self.childone
-        deepright = self.childone.find_first_active()
-        if deepright is not None:
-            return deepright
-        return None
-
-
-def tree2dot(root, filename):
-    seen_nodes = []
-
-    def traversal(node):
-        seen_nodes.append(node)
+
+class FlatTree:
+
+    """
+    Array-backed tree: node #n is described by childzero[n], childone[n] and values[n].
+    Nodes are numbered in pre-order, so the root is #0; since the root is nobody's child,
+    a child index of 0 marks a leaf
+    """
+
+    def __init__(self):
+        self.childzero = array.array("H")
+        self.childone = array.array("H")
+        self.values = bytearray()
+
+    def __len__(self):
+        return len(self.values)
+
+    def add_node(self, value=0):
+        """ :return: index of the newly appended node """
+        self.childzero.append(0)
+        self.childone.append(0)
+        self.values.append(value)
+        return len(self.values) - 1
+
+    def isleaf(self, node):
+        return self.childzero[node] == 0
+
+
+def flatten_tree(root):
+    """ convert a tree made of TreeNode objects into a FlatTree """
+    tree = FlatTree()
+    stack = [(root, None, None)]
+    while len(stack) > 0:
+        node, parent, side = stack.pop()
+        index = tree.add_node(node.value[0])
+        if parent is not None:
+            side[parent] = index
         if not node.isleaf:
-            traversal(node.childzero)
-            traversal(node.childone)
+            stack.append((node.childone, index, tree.childone))
+            stack.append((node.childzero, index, tree.childzero))
+    return tree
 
-    traversal(root)
+
+def tree2dot(tree, filename):
     with open(filename, "w") as tfile:
         tfile.write("digraph yggdrasil {\n")
-        for node in seen_nodes:
-            tfile.write("node_" + str(seen_nodes.index(node)))
-            if node.isleaf:
-                tfile.write(" [label=\"%x\"]" % struct.unpack("B", node.value))
+        for node in range(len(tree)):
+            tfile.write("node_" + str(node))
+            if tree.isleaf(node):
+                tfile.write(" [label=\"%x\"]" % tree.values[node])
             else:
                 tfile.write(" [label=\"\"]")
             tfile.write("\n")
-        for node in seen_nodes:
-            if not node.isleaf:
-                tfile.write("node_" + str(seen_nodes.index(node)) + " -> node_" + str(seen_nodes.index(node.childzero)) +
-                            " [label=0]\n")
-                tfile.write("node_" + str(seen_nodes.index(node)) + " -> node_" + str(seen_nodes.index(node.childone)) +
-                            " [label=1]\n")
+        for node in range(len(tree)):
+            if not tree.isleaf(node):
+                tfile.write("node_" + str(node) + " -> node_" + str(tree.childzero[node]) + " [label=0]\n")
+                tfile.write("node_" + str(node) + " -> node_" + str(tree.childone[node]) + " [label=1]\n")
         tfile.write("}\n")
 
 
-def buildtree(root, cursor, bitstream):
+def buildtree(cursor, bitstream):
+    """ parse the vectorized tree in a single pass: the units are laid out in pre-order, so the leftmost
+    active node is always the right child of the most recently expanded node still lacking one
+    :return: FlatTree object, cursor pointing to the first bit after the tree """
+    tree = FlatTree()
+    active = []  # stack of (child array, parent) pairs, i.e. the right-hand children still to be attached
+    hook = None  # where the node being worked on is attached, None for the root
     while True:
-        # get the active node to work on
-        worknode = root.find_first_active()
-        if worknode is None:  # if the tree is completely built, then stop
-            break
         # read the 'spacers'
         downleft_distance = 0
         try:
@@ -135,109 +138,191 @@ def buildtree(root, cursor, bitstream):
             print("Tree parsing aborted: cursor at HEADER + %x, bit #%d" % (math.floor(cursor/8), cursor % 8))
             return None, None
         cursor += 1
+        if cursor >= len(bitstream):
+            print("Tree parsing aborted: cursor at HEADER + %x, bit #%d" % (math.floor(cursor/8), cursor % 8))
+            return None, None
+        # expand, always moving to the left child, then turn the last node into a leaf
+        for i in range(downleft_distance + 1):
+            worknode = tree.add_node()
+            if hook is not None:
+                hook[0][hook[1]] = worknode
+            hook = (tree.childzero, worknode)
+            active.append((tree.childone, worknode))
+        active.pop()  # the leaf won't have children
         # read the byte
-        value = bitstream[cursor:cursor+8].tobytes()
+        tree.values[worknode] = bitstream[cursor:cursor+8].tobytes()[0]
         cursor += 8
-        for i in range(downleft_distance):
-            worknode = worknode.expand_node()
-        worknode.set_value(value)
-    return root, cursor
-
-def uncompress(binfile, destfile, numbytes, bytes_out, debuggy=False):
-    bitstream = bitarray.bitarray(endian="big")
-    bitstream.frombytes(binfile.read(numbytes))
-    cursor = 0
-    root = TreeNode()
-    bytes_written = 0
-
-    root, cursor = buildtree(root, cursor, bitstream)
-    if root is None:
+        if len(active) == 0:  # if the tree is completely built, then stop
+            break
+        hook = active.pop()
+    return tree, cursor
+
+
+def walk_bits(tree, node, bits, emitted):
+    """ navigate the tree starting from node, following the given navigator bits;
+    whenever a leaf is reached its value is appended to emitted, and the walk restarts from the root
+    :return: index of the node the walk stopped on """
+    childzero = tree.childzero
+    childone = tree.childone
+    for bit in bits:
+        if bit:
+            node = childone[node]
+        else:
+            node = childzero[node]
+        if childzero[node] == 0:
+            emitted.append(tree.values[node])
+            node = 0
+    return node
+
+
+def build_decode_table(tree):
+    """ turn the tree into a state machine consuming a whole byte of navigator bits per step.
+    The states are the non-leaf nodes, since reaching a leaf always sends tarzan back to the root (state 0)
+    :return: state of each node (None for leaves), and a list indexed by state * 256 + input byte,
+     whose items are (decoded bytes, next state) tuples """
+    internals = [node for node in range(len(tree)) if not tree.isleaf(node)]
+    states = [None] * len(tree)
+    for state, node in enumerate(internals):
+        states[node] = state
+
+    # resolve 4 bits at a time first, then glue two nibbles together
+    nibbles = []
+    for node in internals:
+        for nib in range(16):
+            emitted = []
+            stop = walk_bits(tree, node, ((nib >> shift) & 1 for shift in (3, 2, 1, 0)), emitted)
+            nibbles.append((bytes(emitted), states[stop]))
+    table = []
+    for state in range(len(internals)):
+        for highout, midstate in nibbles[state * 16:(state + 1) * 16]:
+            for lowout, nextstate in nibbles[midstate * 16:(midstate + 1) * 16]:
+                table.append((highout + lowout, nextstate))
+    return states, table
+
+
+def decode_blocks(tree, rawdata, cursor, blocksize):
+    """ generator of the decoded data, one block at a time, using the state machine of build_decode_table
+    :param cursor: first bit of the data area """
+    bitstream = bitarray.bitarray(buffer=rawdata, endian="big")
+    states, table = build_decode_table(tree)
+
+    # the data area starts mid-byte: walk the bits up to the next byte boundary one by one
+    emitted = []
+    aligned = min(-(-cursor // 8), len(rawdata))
+    state = states[walk_bits(tree, 0, bitstream[cursor:aligned * 8], emitted)]
+    yield bytes(emitted)
+
+    # then feed the state machine whole bytes
+    for blockstart in range(aligned, len(rawdata), blocksize):
+        emitted = []
+        for byte in rawdata[blockstart:blockstart + blocksize]:
+            out, state = table[(state << 8) | byte]
+            emitted.append(out)
+        yield b"".join(emitted)
+
+
+def uncompress(binfile, destfile, numbytes, bytes_out, debuggy=False, blocksize=0x4000, table_payoff=128):
+    """
+    :param table_payoff: bytes of compressed data per tree node needed for the decoding table to pay for
+     itself: on smaller chunks (few bytes, many different values) the bits are walked one by one instead
+    """
+    rawdata = binfile.read(numbytes)  # may be a memoryview (see datamover.MappedFile), don't copy it
+    bitstream = bitarray.bitarray(buffer=rawdata, endian="big")
+    numbytes = len(rawdata)
+
+    tree, cursor = buildtree(0, bitstream)
+    if tree is None:
         print("Tree construction failed, exiting")
         return
 
     if debuggy:
         print("Tree parsing finished: cursor at %x, bit #%d" % (math.floor(cursor/8), cursor % 8))
-        tree2dot(root, "debugtree.dot")
-
-    while bytes_written < bytes_out:
-        tarzan = root
-        while not tarzan.isleaf:
-            try:
-                chu = bitstream[cursor]
-            except IndexError:
-                print("Data parsing aborted: end of bitstream, cursor at %x, bit #%d (%d/%d bytes written)"
-                      % (math.floor(cursor/8), cursor % 8, bytes_written, bytes_out))
-                return
-            cursor += 1
-            if chu == False:
-                tarzan = tarzan.childzero
-            else:
-                tarzan = tarzan.childone
-        destfile.write(tarzan.value)
-        bytes_written += 1
+        tree2dot(tree, "debugtree.dot")
 
-def collectBytes(Lb, multib, sourcefile, start_offs, end_offs):
-    sourcefile.seek(start_offs, 0)
-    readbyte = sourcefile.read(1)
-    target_read = 0
-    while readbyte and (target_read < (end_offs - start_offs)):
-        if readbyte not in Lb:
-            Lb.append(readbyte)
-            multib[readbyte] = 1
-        else:
-            multib[readbyte] += 1
-        readbyte = sourcefile.read(1)
-        target_read += 1
+    if tree.isleaf(0):  # single-leaf tree: every byte is the root's value, no navigator bits are used
+        destfile.write(tree.values[0:1] * bytes_out)
+        return
 
+    if numbytes - cursor // 8 < table_payoff * (len(tree) // 2):  # a full tree has len // 2 inner nodes
+        emitted = []
+        walk_bits(tree, 0, bitstream[cursor:], emitted)
+        blocks = [bytes(emitted)]
+    else:
+        blocks = decode_blocks(tree, rawdata, cursor, blocksize)
 
-def buildHuffmanTree(sourcefile, start_offs, end_offs):
-    Lb = []
-    multib = {}
+    bytes_written = 0
+    for decoded in blocks:
+        if len(decoded) >= bytes_out - bytes_written:
+            destfile.write(decoded[:bytes_out - bytes_written])
+            return
+        destfile.write(decoded)
+        bytes_written += len(decoded)
+
+    cursor = len(bitstream)
+    print("Data parsing aborted: end of bitstream, cursor at %x, bit #%d (%d/%d bytes written)"
+          % (math.floor(cursor/8), cursor % 8, bytes_written, bytes_out))
+
+
+def byte_histogram(data):
+    """ :return: 256-entry list, containing the number of occurrences of each byte value in data """
+    histogram = [0] * 256
+    for byte, count in Counter(data).items():
+        histogram[byte] = count
+    return histogram
+
+
+def buildHuffmanTree(histogram, data):
+    """
+    :param histogram: 256-entry list of byte occurrences, as returned by byte_histogram
+    :param data: the bytes the histogram was taken from: bytes with the same count are taken in order of
+     first appearance, so that the tree (hence the output) is the same as it's always been
+    """
+    present = [b for b in range(256) if histogram[b] > 0]
+    first_seen = {b: data.find(bytes((b,))) for b in present}
     nodemap = []
-    def keyfun(elem):
-        return multib[elem]
-    collectBytes(Lb, multib, sourcefile, start_offs, end_offs)
-    Lb = sorted(Lb, key=keyfun)
-
-    for b in Lb:
+    # (cost, insertion order, node): on equal cost, the node queued first is merged first
+    for order, b in enumerate(sorted(present, key=lambda b: (histogram[b], first_seen[b]))):
         nn = TreeNode()
-        nn.set_value(b)
-        nodemap.append((b, nn, multib[b]))
+        nn.set_value(bytes((b,)))
+        nodemap.append((histogram[b], order, nn))
+    heapq.heapify(nodemap)
+    order = len(nodemap)
 
     while len(nodemap) > 1:
-        uno = nodemap.pop(0)
-        due = nodemap.pop(0)
+        uno = heapq.heappop(nodemap)
+        due = heapq.heappop(nodemap)
         radix = TreeNode()
-        radix.childzero = uno[1]
-        radix.childone = due[1]
-        newcost = uno[2] + due[2]
-        i = 0
-        while i < len(nodemap):
-            if nodemap[i][2] > newcost:
-                break
-            i += 1
-        nodemap.insert(i, (0, radix, newcost))
+        radix.childzero = uno[2]
+        radix.childone = due[2]
+        heapq.heappush(nodemap, (uno[0] + due[0], order, radix))
+        order += 1
+
+    return nodemap[0][2]
 
-    return nodemap[0][1]
+
+def build_code_table(tree):
+    """ walk the whole tree once, collecting the navigator bits leading to each leaf
+    :return: 256-entry list of bitarray codes, indexed by byte value (None for the bytes not in the tree) """
+    codes = [None] * 256
+    stack = [(tree, bitarray.bitarray(endian="big"))]
+    while len(stack) > 0:
+        node, path = stack.pop()
+        if node.isleaf:
+            codes[node.value[0]] = path
+        else:
+            righty = path.copy()
+            righty.append(True)
+            path.append(False)
+            stack.append((node.childone, righty))
+            stack.append((node.childzero, path))
+    return codes
 
 
 def compress(sourcefile, start_offs, end_offs, debuggy=False):
     """ :return: bitarray object containing the compressed data """
-    lookup_table = {}
     vecbuild_path = bitarray.bitarray(endian="big")
     out_bitstream = bitarray.bitarray(endian="big")
 
-    def build_lookup_table(node, path, search):
-        if not node.isleaf:
-            lefty = path.copy()
-            lefty.append(False)
-            righty = path.copy()
-            righty.append(True)
-            build_lookup_table(node.childzero, lefty, search)
-            build_lookup_table(node.childone, righty, search)
-        elif node.value == search:
-            lookup_table[search] = path
-
     def build_vector_tree(node):
         if node.isleaf:
             vecbuild_path.append(False)
@@ -251,21 +336,18 @@ def compress(sourcefile, start_offs, end_offs, debuggy=False):
             build_vector_tree(node.childzero)
             build_vector_tree(node.childone)
 
-    tree = buildHuffmanTree(sourcefile, start_offs, end_offs)
-    sourcefile.seek(start_offs)
+    sourcefile.seek(start_offs, 0)
+    data = sourcefile.read(end_offs - start_offs)
+    tree = buildHuffmanTree(byte_histogram(data), data)
 
     if debuggy:
-        tree2dot(tree, "optimumtree.dot")
+        tree2dot(flatten_tree(tree), "optimumtree.dot")
 
     build_vector_tree(tree)
 
-    datum = sourcefile.read(1)
-    target_read = 0
-    while datum and (target_read < (end_offs - start_offs)):
-        if datum not in lookup_table.keys():
-            build_lookup_table(tree, bitarray.bitarray(endian="big"), datum)
-        out_bitstream.extend(lookup_table[datum])
-        datum = sourcefile.read(1)
-        target_read += 1
+    # encode the whole chunk in one go; a single-leaf tree needs no navigator bits at all
+    if not tree.isleaf:
+        lookup_table = build_code_table(tree)
+        out_bitstream.encode({datum: code for datum, code in enumerate(lookup_table) if code is not None}, data)
 
     return out_bitstream
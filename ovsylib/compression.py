@@ -1,11 +1,15 @@
 import struct
 import os
+import io
+import shutil
+import tempfile
 from ovsylib.aggressive_threading import Broker
-from threading import Thread
+from ovsylib.datamover import RangeReader, dd
+from threading import Thread, Event
 
 from ovsylib.compresion_algos import yggdrasil
-from ovsylib.utils.constants import intsize
 from ovsylib.utils.exceptions import BadMagicNum
+from ovsylib.utils.pickling import restore_slots
 
 
 def checksize(binfile):
@@ -23,6 +27,10 @@ class Algo1:
     Handles a single chunk of compressed data
     """
 
+    __slots__ = ("uncomp_size", "comp_size", "rootaddress", "header_write_back_offset", "id", "size", "bitstream",
+                 "spill")
+    __setstate__ = restore_slots
+
     def __init__(self, id, size):
         self.uncomp_size = 0
         self.comp_size = 0
@@ -31,11 +39,16 @@ class Algo1:
         self.id = id
         self.size = size
         self.bitstream = None
+        self.spill = None  # file holding the compressed data instead of bitstream, see spawn
+
+    subheader = struct.Struct("<III")
 
     def loadSubHeaderFromFile(self, binfile):
-        self.uncomp_size = struct.unpack("I", binfile.read(intsize))[0]
-        self.comp_size = struct.unpack("I", binfile.read(intsize))[0]
-        self.rootaddress = struct.unpack("I", binfile.read(intsize))[0]
+        self.loadSubHeader(self.subheader.unpack(binfile.read(self.subheader.size)))
+
+    def loadSubHeader(self, data):
+        """ :param data: tuple, as returned by Algo1.subheader.unpack() """
+        self.uncomp_size, self.comp_size, self.rootaddress = data
 
     def decompress(self, binfile, metadata_offset, savefile, debuggy=False):
         binfile.seek(metadata_offset + self.rootaddress, 0)
@@ -49,10 +62,16 @@ class Algo1:
             savefile.write(struct.pack("I", self.rootaddress))
 
     def writeToFile(self, savefile, metadata_offset, dry_run=False):
-        """ actually writes out the compressed data. Can be run only after compress """
-        assert self.bitstream is not None
+        """ actually writes out the compressed data. Can be run only after compress (or spawn) """
         self.rootaddress = savefile.tell() - metadata_offset
-        savefile.write(self.bitstream.tobytes())
+        if self.bitstream is not None:
+            savefile.write(self.bitstream.tobytes())
+        else:
+            assert self.spill is not None
+            with open(self.spill, "rb") as spillfile:
+                dd(spillfile, savefile, 0, self.comp_size)
+            os.remove(self.spill)
+            self.spill = None
         afterwrite_offset = savefile.tell()
         savefile.seek(self.header_write_back_offset, 0)
         self.writeSubHeader(savefile, dry_run=dry_run)
@@ -95,9 +114,39 @@ class after_comp_callback:
 
 
 # needs to be standalone, for multiprocess to pickle it
-def spawn(chunk, sourcefile_name, debuggy):
+def spawn(chunk, sourcefile_name, debuggy, spill_dir=None):
+    """ :param spill_dir: if set, the compressed data is written to a new file in this directory, so that only
+     the chunk's metadata has to be pickled back to the parent process """
     with open(sourcefile_name, "rb") as sourcefile:
-        return chunk.compress(sourcefile, debuggy=debuggy)
+        chunk.compress(sourcefile, debuggy=debuggy)
+    if spill_dir is not None:
+        fd, chunk.spill = tempfile.mkstemp(dir=spill_dir)
+        with os.fdopen(fd, "wb") as spillfile:
+            chunk.bitstream.tofile(spillfile)
+        chunk.bitstream = None
+    return chunk
+
+
+def spill_directory(threads, near):
+    """ :return: a new temporary directory for spawn(), next to the file near (so the kernel can move the data
+     around without crossing filesystems); None if threads doesn't run on subprocesses, which need no spilling.
+     The caller has to remove it (see remove_spill_directory) """
+    if threads.executor != "process":
+        return None
+    return tempfile.mkdtemp(prefix=".ovs_spill", dir=os.path.dirname(os.path.abspath(near)))
+
+
+def remove_spill_directory(spill_dir):
+    if spill_dir is not None:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+
+# same as above, the decompressed data is written straight to its place in the output file
+def spawn_decompress(chunk, binfile_name, metadata_offset, savefile_name, output_offset, debuggy):
+    with open(binfile_name, "rb") as binfile, open(savefile_name, "r+b") as savefile:
+        savefile.seek(output_offset, 0)
+        chunk.decompress(binfile, metadata_offset, savefile, debuggy=debuggy)
+    return chunk.id
 
 
 class Chuunicomp:
@@ -107,6 +156,9 @@ class Chuunicomp:
     """
 
     default_chunksize = 0x20000
+    header = struct.Struct("<IIII")
+    __slots__ = ("magicseq", "chunk_num", "chunksize", "header_size", "chunks", "aftercompress_callback_obj")
+    __setstate__ = restore_slots
 
     def __init__(self):
         self.magicseq = 0
@@ -117,13 +169,20 @@ class Chuunicomp:
         self.aftercompress_callback_obj = None  # see class after_comp_callback
 
     def fromBinfile(self, binfile):
-        self.magicseq = struct.unpack("I", binfile.read(intsize))[0]
-        self.chunk_num = struct.unpack("I", binfile.read(intsize))[0]
-        self.chunksize = struct.unpack("I", binfile.read(intsize))[0]
-        self.header_size = struct.unpack("I", binfile.read(intsize))[0]
-        self.chunks = self.prepareChunks(binfile)
+        self.magicseq, self.chunk_num, self.chunksize, self.header_size = \
+            self.header.unpack(binfile.read(self.header.size))
         if self.magicseq != 0x1234:
             raise BadMagicNum(self.magicseq)
+        self.chunks = self.prepareChunks(binfile)
+
+    def fromTables(self, header, subheaders):
+        """
+        Initialize from already unpacked data
+        :param header: tuple, as returned by Chuunicomp.header.unpack()
+        :param subheaders: iterable of tuples, as returned by Algo1.subheader.unpack()
+        """
+        self.magicseq, self.chunk_num, self.chunksize, self.header_size = header
+        self.chunks = self.prepareChunks(subheaders=subheaders)
 
     def fromFutureImport(self, chunksnum):
         self.magicseq = 0x1234
@@ -132,23 +191,59 @@ class Chuunicomp:
         self.chunks = self.prepareChunks(None)
         self.header_size = (4 + (3 * chunksnum)) * 4
 
-    def prepareChunks(self, binfile=None):
+    def prepareChunks(self, binfile=None, subheaders=None):
         body = []
+        if binfile is not None:  # all the sub-headers are read at once
+            subheaders = Algo1.subheader.iter_unpack(binfile.read(Algo1.subheader.size * self.chunk_num))
+        if subheaders is not None:
+            subheaders = iter(subheaders)
         for i in range(self.chunk_num):
             piece = Algo1(i, self.chunksize)
-            if binfile is not None:
-                piece.loadSubHeaderFromFile(binfile)
+            if subheaders is not None:
+                piece.loadSubHeader(next(subheaders))
             body.append(piece)
         return body
 
-    def decompress(self, binfile, savefile, debuggy=False):
+    def decompress(self, binfile, savefile, debuggy=False, parallel=False):
         """ we don't read the header at decompression time, since we have already acquired the data
-        via fromBinfile(). Hence we simply skip the header """
+        via fromBinfile(). Hence we simply skip the header.
+        If parallel is set, the chunks are decompressed in subprocesses, each one writing directly
+        to its own region of savefile; both files must then be actual on-disk files """
         binfile.seek(self.header_size, 1)
         metadata_offset = binfile.tell()
+        if parallel and len(self.chunks) > 1:
+            self.parallel_decompress(binfile.name, metadata_offset, savefile, debuggy=debuggy)
+            return
         for chunk in self.chunks:
             chunk.decompress(binfile, metadata_offset, savefile, debuggy=debuggy)
 
+    def parallel_decompress(self, binfile_name, metadata_offset, savefile, debuggy=False):
+        threads = Broker(len(self.chunks), debugmode=debuggy, greed=1)
+        output_offset = savefile.tell()
+        jobs = []
+        for chunk in self.chunks:
+            jobs.append((chunk, binfile_name, metadata_offset, savefile.name, output_offset, debuggy))
+            output_offset += chunk.uncomp_size
+
+        # make room for the whole output, so that the workers can write in any order
+        savefile.truncate(output_offset)
+        savefile.flush()
+
+        def spawnAll(joblist):
+            for job in joblist:
+                threads.appendNfire(spawn_decompress, job)
+
+        feeder = Thread(target=spawnAll, args=(jobs,))
+        feeder.start()
+        try:
+            for job in jobs:
+                threads.collect_one()
+        finally:
+            feeder.join()  # every job gets launched anyway, the completed ones make room for the rest
+            threads.discard()
+            threads.stop()
+        savefile.seek(output_offset, 0)
+
     def writeHeader(self, savefile, dry_run=False):
         if not dry_run:
             savefile.write(struct.pack("I", self.magicseq))
@@ -156,32 +251,59 @@ class Chuunicomp:
             savefile.write(struct.pack("I", self.chunksize))
             savefile.write(struct.pack("I", self.header_size))
 
-    def compress(self, sourcefile_name, savefile, dry_run=False, debuggy=False):
+    def spawnChunks(self, sourcefile_name, threads, debuggy=False, stop=None, spill_dir=None):
+        """ queue the compression of every chunk on the broker, in order
+        :param stop: threading.Event, checked before queuing each chunk
+        :param spill_dir: see spawn
+        :return: False if the queuing was interrupted """
+        for chunk in self.chunks:
+            if stop is not None and stop.is_set():
+                return False
+            if not threads.appendNfire(spawn, (chunk, sourcefile_name, debuggy, spill_dir)):
+                return False
+        return True
+
+    def compress(self, sourcefile_name, savefile, dry_run=False, debuggy=False, threads=None, queued=False):
         """ run the compression algorithm for each chunk, in parallel. Note that the
-        caller has the duty to set the file seek in the right position before calling this. """
+        caller has the duty to set the file seek in the right position before calling this.
+        :param threads: Broker object to run the chunks on; if None, a new one is started (and stopped)
+        :param queued: the chunks were already queued on threads (see spawnChunks), the next results
+         to be collected from it are this object's chunks """
         totalcomp = 0
-        threads = Broker(len(self.chunks), debugmode=debuggy, greed=1)
-
-        def spawnAll(chunklist):
-            for chunk in chunklist:
-                threads.appendNfire(spawn, (chunk, sourcefile_name, debuggy))
+        own_broker = threads is None
+        spill_dir = None
+        if own_broker:
+            threads = Broker(len(self.chunks), debugmode=debuggy, greed=1)
+            spill_dir = spill_directory(threads, savefile.name)
 
         self.writeHeader(savefile, dry_run=dry_run)
         for chunk in self.chunks:
             chunk.writeSubHeader(savefile, dry_run=dry_run)
         metadata_offset = savefile.tell()
 
-        # this thread will feed the broker with tasks
-        Thread(target=spawnAll, args=(self.chunks,)).start()
+        feeder = None
+        stop_feeding = Event()
+        if not queued:
+            # this thread will feed the broker with tasks
+            feeder = Thread(target=self.spawnChunks, args=(sourcefile_name, threads, debuggy),
+                            kwargs={"stop": stop_feeding, "spill_dir": spill_dir})
+            feeder.start()
 
         # gather all the results, write them in sequence
-        collected = 0
-        while collected < len(self.chunks):
-            for partial in threads.collect():
-                totalcomp += partial.bitstream.buffer_info()[1]
+        try:
+            for chunk in self.chunks:
+                partial = threads.collect_one()
+                partial.header_write_back_offset = chunk.header_write_back_offset  # may have been queued before it was known
+                totalcomp += partial.comp_size
                 partial.writeToFile(savefile, metadata_offset, dry_run=dry_run)
-                collected += 1
-        threads.stop()
+        finally:
+            stop_feeding.set()
+            if own_broker:
+                threads.discard()
+                if feeder is not None:
+                    feeder.join()
+                threads.stop()  # no chunk is still writing into spill_dir
+                remove_spill_directory(spill_dir)
         if self.aftercompress_callback_obj is not None:
             self.aftercompress_callback_obj.compressed(totalcomp + self.header_size, dry_run=dry_run)
         return totalcomp + 4
@@ -190,4 +312,46 @@ class Chuunicomp:
         print("     Compression chunks: %d , header size: %04x" % (self.chunk_num, self.header_size))
         for chunk in self.chunks:
             print("     chunk #%03d: " % (self.chunks.index(chunk),), end="")
-            chunk.print_info()
\ No newline at end of file
+            chunk.print_info()
+
+
+class ChunkReader(RangeReader):
+
+    """
+    Read-only, seekable file-like view over the uncompressed content of a Chuunicomp section.
+    Only the chunks covering the requested bytes are decompressed; the last one is kept cached
+    """
+
+    def __init__(self, compr_object, binfile, offset):
+        """
+        :param compr_object: Chuunicomp object, already loaded
+        :param binfile: file object
+        :param offset: absolute offset of the compressed section (i.e. of its header)
+        """
+        length = sum(chunk.uncomp_size for chunk in compr_object.chunks)
+        super().__init__(binfile, offset + compr_object.header_size, length)
+        self.compr_object = compr_object
+        self.cached_id = None
+        self.cached_data = b""
+
+    def load_chunk(self, chunk_id):
+        if chunk_id != self.cached_id:
+            decompressed = io.BytesIO()
+            self.compr_object.chunks[chunk_id].decompress(self.binfile, self.offset, decompressed)
+            self.cached_data = decompressed.getvalue()
+            self.cached_id = chunk_id
+        return self.cached_data
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        chunksize = self.compr_object.chunksize
+        count = 0
+        while count < len(buffer) and self.position < self.length:
+            chunk_id, displacement = divmod(self.position, chunksize)
+            data = self.load_chunk(chunk_id)[displacement:displacement + len(buffer) - count]
+            if len(data) == 0:  # truncated chunk
+                break
+            buffer[count:count + len(data)] = data
+            count += len(data)
+            self.position += len(data)
+        return count
@@ -1,26 +1,229 @@
-from math import ceil
+import io
+import os
+import mmap
 
 
-def read_file_chunk(file, chunk_size=1024):
-    while True:
-        block = file.read(chunk_size)
-        if not block:
+def kernel_copy(infd, outfd, offset, position, length):
+    """
+    Copy a byte range between two file descriptors without passing the data through python,
+    via copy_file_range() or, failing that, sendfile(). The seek of infd is not modified.
+    :return: number of bytes copied, may be short if the kernel refused (or the input ended)
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                done = os.copy_file_range(infd, outfd, length - copied, offset + copied, position + copied)
+                if done == 0:
+                    return copied
+                copied += done
+            return copied
+        except OSError:  # i.e. cross-filesystem copy on older kernels
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            os.lseek(outfd, position + copied, os.SEEK_SET)
+            while copied < length:
+                done = os.sendfile(outfd, infd, offset + copied, length - copied)
+                if done == 0:
+                    return copied
+                copied += done
+        except OSError:
+            pass
+    return copied
+
+
+def buffered_copy(iffy, vert, offset, position, length, blocksize):
+    """ plain read/write copy of a byte range, through a single reusable buffer
+    :return: number of bytes copied """
+    buffer = memoryview(bytearray(min(blocksize, length)))
+    iffy.seek(offset)
+    vert.seek(position)
+    copied = 0
+    while copied < length:
+        done = iffy.readinto(buffer[:min(blocksize, length - copied)])
+        if not done:
             break
-        yield block
+        vert.write(buffer[:done])
+        copied += done
+    return copied
+
 
-def dd(iffy, vert, offset, length, blocksize=1024):
+def dd(iffy, vert, offset, length, blocksize=0x100000, dest_offset=None):
     """
-    Works just like the dd linux command
+    Works just like the dd linux command; the copy is done by the kernel when both are on-disk files.
+    The seek of iffy is not preserved
     :param iffy: input file
     :param vert: output file
+    :param dest_offset: where to write in vert, whose seek is then left untouched;
+     if None, write at the current position and advance it
     """
-    compa = ceil(length / blocksize)
-    saved_seek = iffy.tell()
-    iffy.seek(offset)
-    for i in range(compa):
-        data = next(read_file_chunk(iffy, blocksize))
-        if i == compa - 1:
-            falcom = length % blocksize
-            data = data[:falcom]
-        vert.write(data)
-    iffy.seek(saved_seek)
+    if length <= 0:
+        return
+    vert.flush()
+    saved_seek = vert.tell()
+    position = saved_seek if dest_offset is None else dest_offset
+    copied = 0
+    try:
+        infd = iffy.fileno()
+        outfd = vert.fileno()
+    except (AttributeError, io.UnsupportedOperation):  # in-memory files
+        infd = None
+    if infd is not None:
+        copied = kernel_copy(infd, outfd, offset, position, length)
+    if copied < length:
+        copied += buffered_copy(iffy, vert, offset + copied, position + copied, length - copied, blocksize)
+    if dest_offset is None:
+        vert.seek(position + copied)
+    else:
+        vert.seek(saved_seek)
+
+
+class RangeCopier:
+
+    """
+    Collects byte range copies (see dd) and merges the adjacent ones, i.e. consecutive
+    unchanged entries of a .pac, so that they are moved with a single copy
+    """
+
+    def __init__(self, iffy, vert):
+        self.iffy = iffy
+        self.vert = vert
+        self.offset = 0
+        self.position = 0
+        self.length = 0
+
+    def copy(self, offset, position, length):
+        """ copy length bytes from iffy (at offset) to vert (at position); vert's seek is not used nor modified """
+        if self.length > 0 and offset == self.offset + self.length and position == self.position + self.length:
+            self.length += length
+            return
+        self.flush()
+        self.offset = offset
+        self.position = position
+        self.length = length
+
+    def flush(self):
+        """ actually perform the pending copy """
+        if self.length > 0:
+            dd(self.iffy, self.vert, self.offset, self.length, dest_offset=self.position)
+        self.length = 0
+
+
+class RangeReader(io.RawIOBase):
+
+    """
+    Read-only, seekable file-like view over a byte range of another file
+    """
+
+    def __init__(self, binfile, offset, length):
+        super().__init__()
+        self.binfile = binfile
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer):
+        count = min(len(buffer), max(0, self.length - self.position))
+        if count == 0:
+            return 0
+        self.binfile.seek(self.offset + self.position, 0)
+        count = self.binfile.readinto(memoryview(buffer).cast("B")[:count])
+        self.position += count
+        return count
+
+
+class MappedFile:
+
+    """
+    Read-only, memory-mapped file object: read() returns memoryview slices of the mapping
+    rather than copies of the data. Cursors share the same mapping, but each one has its own
+    seek, so that many threads can read concurrently
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.position = 0
+        self.parent = parent
+        if parent is None:
+            self.file = open(name, "rb")
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mapping)
+        else:
+            self.file = parent.file
+            self.mapping = parent.mapping
+            self.view = parent.view
+
+    def cursor(self):
+        """ :return: a new MappedFile object, sharing the mapping with this one """
+        return MappedFile(self.name, parent=self)
+
+    def read(self, size=-1):
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(end, self.position + size)
+        data = self.view[self.position:end]
+        self.position = max(self.position, end)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(memoryview(buffer).cast("B")))
+        memoryview(buffer).cast("B")[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.parent is None:
+            self.view.release()
+            try:
+                self.mapping.close()
+            except BufferError:  # some slices are still in use, the mapping will go away with them
+                pass
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_binfile(name, mapped=False):
+    """ open a file for reading, either normally or memory-mapped (see MappedFile) """
+    if mapped:
+        return MappedFile(name)
+    return open(name, "rb")
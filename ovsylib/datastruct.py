@@ -2,11 +2,14 @@ import struct
 import os
 import math
 from operator import attrgetter
+from threading import Thread, Event
+from bisect import bisect_left
 
 from ovsylib import datamover, compression, customsort
-from ovsylib.utils.binary import put_string, get_string
+from ovsylib.aggressive_threading import Broker, Prefetcher, getMaxThreads
+from ovsylib.utils.binary import pack_string, unpack_string
 from ovsylib.utils.filenames import adjust_separator_for_fs, adjust_separator_for_pac
-from ovsylib.utils.constants import intsize
+from ovsylib.utils.pickling import restore_slots
 
 
 """
@@ -23,21 +26,20 @@ class Header:
     .pac file header
     """
 
+    record = struct.Struct("<8sIII")
+
     def __init__(self):
         self.nfiles = 0
         self.dwpack = ""
 
     def load_metadata(self, binfile):
-        self.dwpack = get_string(binfile, 8)
-        data = struct.unpack("III", binfile.read(intsize * 3))
-        self.nfiles = data[1]
+        data = self.record.unpack(binfile.read(self.record.size))
+        self.dwpack = unpack_string(data[0])
+        self.nfiles = data[2]
 
     def write_metadata(self, binfile, dry_run=False):
         if not dry_run:
-            put_string(binfile, 8, self.dwpack)
-            binfile.write(struct.pack("I", 0))
-            binfile.write(struct.pack("I", self.nfiles))
-            binfile.write(struct.pack("I", 0))
+            binfile.write(self.record.pack(pack_string(8, self.dwpack), 0, self.nfiles, 0))
 
     def print_info(self):
         print("  header (%s) File count: %d" % (self.dwpack, self.nfiles))
@@ -45,6 +47,14 @@ class Header:
 
 class FileEntry:
 
+    record = struct.Struct("<II260sIIIII")  # directory entry, 288 bytes (see pac_format.txt)
+    comp_size_field = struct.calcsize("<II260sI")  # position of comp_size inside the record
+    offset_field = struct.calcsize("<II260sIIII")
+
+    # no per-instance __dict__: big packages have tens of thousands of entries
+    __slots__ = ("id", "name", "size", "offset", "compressed", "compr_object", "comp_size", "import_from",
+                 "origin_offset", "offset_writeback_location", "compr_tables")
+
     def __init__(self):
         self.id = 0
         self.name = ""
@@ -56,6 +66,11 @@ class FileEntry:
         self.import_from = ""  # if empty, it means we're writing to a new .pac file
         self.origin_offset = None  # (same as self.offset) used to read data from those entries which are copied from an existing .pac
         self.offset_writeback_location = 0
+        self.compr_tables = None  # compression info known in advance (see pacindex): (header tuple, packed sub-headers)
+
+    def __setstate__(self, state):
+        self.compr_tables = None  # missing from the environments saved before it existed
+        restore_slots(self, state)
 
     def load_metadata(self, binfile):
         """
@@ -63,15 +78,21 @@ class FileEntry:
         :param binfile: file object
         :return:
         """
-        data = struct.unpack("II", binfile.read(intsize * 2))
+        self.load_record(self.record.unpack(binfile.read(self.record.size)))
+
+    def load_record(self, data):
+        """
+        Initialize the metadata from an unpacked directory entry
+        :param data: tuple, as returned by FileEntry.record.unpack()
+        :return:
+        """
         self.id = data[1]
-        self.name = get_string(binfile, 260)
-        data = struct.unpack("IIIII", binfile.read(intsize * 5))
-        self.comp_size = data[1]
-        self.size = data[2]
-        if data[3] != 0:
+        self.name = unpack_string(data[2])
+        self.comp_size = data[4]
+        self.size = data[5]
+        if data[6] != 0:
             self.compressed = True
-        self.offset = data[4]   # note: the offset read here is relative to the beginning of the data area
+        self.offset = data[7]   # note: the offset read here is relative to the beginning of the data area
 
     def load_compression_info(self, binfile):
         """
@@ -86,6 +107,22 @@ class FileEntry:
         except compression.BadMagicNum as e:
             print("Warning: bad magic sequence (%x) in file %s" % (int(str(e)), self.name))
 
+    def need_compression_info(self, binfile):
+        """
+        The compression info are loaded lazily: call this before using compr_object, seek is not preserved.
+        If compr_tables is set, compr_object is built from it and binfile is not touched
+        :param binfile: file object
+        :return:
+        """
+        if self.compressed and self.compr_object is None:
+            if self.compr_tables is not None:
+                header, subheaders = self.compr_tables
+                self.compr_object = compression.Chuunicomp()
+                self.compr_object.fromTables(header, compression.Algo1.subheader.iter_unpack(subheaders))
+                self.compr_tables = None
+            else:
+                self.load_compression_info(binfile)
+
     def create_from_file(self, name, filepath, compress=True, adjust_separator=True):
         """
         Prepare the FileEntry to receive data from an on-disk file to be packed
@@ -107,11 +144,14 @@ class FileEntry:
             chunknum = max(1, int(math.ceil(self.size / self.compr_object.default_chunksize)))
             self.compr_object.fromFutureImport(chunknum)
 
-    def _dump2file(self, fromfile, tofile):
-        actual_len = self.size
+    def stored_size(self):
+        """ :return: number of bytes the data takes inside the .pac file """
         if self.compressed:
-            actual_len = self.comp_size
-        datamover.dd(fromfile, tofile, self.offset, actual_len)
+            return self.comp_size
+        return self.size
+
+    def _dump2file(self, fromfile, tofile):
+        datamover.dd(fromfile, tofile, self.offset, self.stored_size())
 
     def dump_myself(self, location, binfile):
         """
@@ -124,22 +164,35 @@ class FileEntry:
         with open(location, "wb") as savefile:
             self._dump2file(binfile, savefile)
 
-    def extract_myself(self, location, binfile, debuggy=False):
+    def extract_myself(self, location, binfile, debuggy=False, parallel=False):
         """
         Write data to a path on disk, uncompress if needed
         :param location: file path string
         :param binfile: file object
         :param debuggy:
+        :param parallel: decompress the chunks in parallel
         :return:
         """
         print("Extracting %s to %s" % (self.name, location))
+        self.need_compression_info(binfile)
         with open(location, "wb") as savefile:
             if self.compressed:
                 binfile.seek(self.offset, 0)
-                self.compr_object.decompress(binfile, savefile, debuggy=debuggy)
+                self.compr_object.decompress(binfile, savefile, debuggy=debuggy, parallel=parallel)
             else:
                 self._dump2file(binfile, savefile)
 
+    def open(self, binfile):
+        """
+        Read-only access to the (uncompressed) data, without extracting it
+        :param binfile: file object, it must stay open while the returned object is used
+        :return: seekable file-like object
+        """
+        if self.compressed:
+            self.need_compression_info(binfile)
+            return compression.ChunkReader(self.compr_object, binfile, self.offset)
+        return datamover.RangeReader(binfile, self.offset, self.size)
+
     def write_out_metadata(self, updated, dry_run=False):
         """
         Write a copy of the metadata to a file
@@ -147,24 +200,29 @@ class FileEntry:
         :param dry_run:
         :return:
         """
+        record = self.pack_metadata(updated, updated.tell())
         if not dry_run:
-            updated.write(struct.pack("I", 0))
-            updated.write(struct.pack("I", self.id))
-            put_string(updated, 260, self.name)
-            updated.write(struct.pack("I", 0))
+            updated.write(record)
+
+    def pack_metadata(self, updated, location):
+        """
+        Prepare a copy of the metadata, to be written at a given position of a file
+        :param updated: file object
+        :param location: absolute position of the directory entry inside updated
+        :return: bytes object
+        """
+        if self.compr_object is not None:
+            self.compr_object.aftercompress_callback_obj = \
+                compression.after_comp_callback(location + self.comp_size_field, updated)
+        self.offset_writeback_location = location + self.offset_field
+        compa = 0
         if self.compressed:
-            self.compr_object.aftercompress_callback_obj = compression.after_comp_callback(updated.tell(), updated)
-        if not dry_run:
-            updated.write(struct.pack("I", self.comp_size))
-            updated.write(struct.pack("I", self.size))
-            compa = 0
-            if self.compressed:
-                compa = 1
-            updated.write(struct.pack("I", compa))
-            self.offset_writeback_location = updated.tell()  # save the
-            updated.write(struct.pack("I", self.offset))
+            compa = 1
+        return self.record.pack(0, self.id, pack_string(260, self.name), 0,
+                                self.comp_size, self.size, compa, self.offset)
 
-    def write_out_data(self, original, updated, metadata_offset, dry_run=False, debuggy=False):
+    def write_out_data(self, original, updated, metadata_offset, dry_run=False, debuggy=False, threads=None,
+                       queued=False, copier=None):
         """
         Write a copy of the data to a file
         :param original: file object
@@ -172,6 +230,10 @@ class FileEntry:
         :param metadata_offset:
         :param dry_run:
         :param debuggy:
+        :param threads: Broker object used to compress the chunks, if None a temporary one is created
+        :param queued: the chunks were already queued on threads, see Chuunicomp.compress
+        :param copier: datamover.RangeCopier from original to updated; if given, the copy of unchanged data
+         is delegated to it (and may be delayed), the seek of updated is moved past the data anyway
         :return:
         """
         def writeback_offset():
@@ -189,10 +251,11 @@ class FileEntry:
 
             if self.compressed:
                 print("Compressing %s (%d chunks) ..." % (self.name, self.compr_object.chunk_num), end="\r")
-                self.comp_size = self.compr_object.compress(self.import_from, updated, dry_run=dry_run, debuggy=debuggy)
+                self.comp_size = self.compr_object.compress(self.import_from, updated, dry_run=dry_run,
+                                                           debuggy=debuggy, threads=threads, queued=queued)
                 print("Compressed %s : %d -> %d (%f)" %
                       (self.name, self.size, self.comp_size, ((self.size - self.comp_size)*100) / self.size))
-            else:  # uncompressed file: copy it byte by byte
+            else:  # uncompressed file: copy it as it is
                 if not dry_run:
                     with open(self.import_from, "rb") as importfile:
                         datamover.dd(importfile, updated, 0, self.size)
@@ -202,10 +265,11 @@ class FileEntry:
             writeback_offset()
 
             if not dry_run:
-                actual_len = self.size
-                if self.compressed:
-                    actual_len = self.comp_size
-                datamover.dd(original, updated, self.origin_offset, actual_len)
+                if copier is not None:
+                    copier.copy(self.origin_offset, self.offset, self.stored_size())
+                    updated.seek(self.offset + self.stored_size(), 0)
+                else:
+                    datamover.dd(original, updated, self.origin_offset, self.stored_size())
 
     def adjust_offset(self, addendum):
         """
@@ -232,23 +296,87 @@ class FileEntry:
 
 class Pacfile:
 
+    compression_lookahead = 4  # compressed chunks waiting to be written, per cpu
+
     def __init__(self):
         self.files = []
         self.header = Header()
         self.metadata_offset = 0
-
-    def load_from_file(self, binfile):
+        self._invalidate_index()
+
+    def __getstate__(self):
+        """ the lookup indexes are not pickled, they are rebuilt on demand """
+        state = self.__dict__.copy()
+        for key in ("_by_id", "_by_name", "_max_id", "_sorted"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._invalidate_index()
+
+    def _invalidate_index(self):
+        """ to be called whenever the file list, the ids or the names change in a way that _index() can't follow """
+        self._by_id = None
+        self._by_name = None
+        self._max_id = None
+        self._sorted = None
+
+    def _index(self):
+        """
+        Lookup indexes over self.files, built on first use
+        :return: dictionaries id -> file, and name -> list of files
+        """
+        if self._by_id is None:
+            by_id = {}
+            by_name = {}
+            for f in self.files:
+                by_id.setdefault(f.id, f)
+                by_name.setdefault(f.name, []).append(f)
+            self._by_name = by_name
+            self._max_id = max(by_id, default=None)
+            self._by_id = by_id  # last, since it marks the indexes as ready (the workers may be threads)
+        return self._by_id, self._by_name
+
+    def _sorted_index(self):
+        """
+        Names in lexicographic order, so that all the names sharing a prefix (i.e. a folder's content)
+        are contiguous, along with the running totals of the file sizes; built on first use
+        :return: sorted names, positions of the files in self.files, cumulative sizes, cumulative stored sizes
+        """
+        if self._sorted is None:
+            order = sorted(range(len(self.files)), key=lambda i: self.files[i].name)
+            names = [self.files[i].name for i in order]
+            sizes = [0]
+            stored_sizes = [0]
+            for i in order:
+                sizes.append(sizes[-1] + self.files[i].size)
+                stored_sizes.append(stored_sizes[-1] + self.files[i].stored_size())
+            self._sorted = (names, order, sizes, stored_sizes)
+        return self._sorted
+
+    def _prefix_range(self, prefix):
+        """ :return: range of the positions (in the sorted index) of the names starting with prefix """
+        names = self._sorted_index()[0]
+        if prefix == "":
+            return 0, len(names)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)  # the first string greater than any name starting with prefix
+        return bisect_left(names, prefix), bisect_left(names, upper)
+
+    def load_from_file(self, binfile, eager=False):
         """
         Initialize the object, taking data from an existing file; after the function terminates, the seek location
         is unspecified.
         :param binfile: file object
+        :param eager: also load the compression info of every file, otherwise they are loaded on first use
         :return:
         """
         self.header.load_metadata(binfile)
         self.load_file_dir_entries(binfile)
         self.metadata_offset = binfile.tell()
         self.adjust_metaoff_displace()
-        self.load_compression_info(binfile)
+        if eager:
+            self.load_compression_info(binfile)
 
     def load_file_dir_entries(self, binfile):
         """
@@ -256,14 +384,30 @@ class Pacfile:
         :param binfile: file object
         :return:
         """
-        for i in range(self.header.nfiles):
+        directory = binfile.read(FileEntry.record.size * self.header.nfiles)
+        for data in FileEntry.record.iter_unpack(directory):
             newfile = FileEntry()
-            newfile.load_metadata(binfile)
+            newfile.load_record(data)
             self.files.append(newfile)
+        self._invalidate_index()
 
     def theorize_metadata_offset(self):
         """ :return: metadata offset calculated from the current number of files """
-        return len(self.files) * ((7 * intsize) + 260) + (intsize * 3 + 8)
+        return len(self.files) * FileEntry.record.size + Header.record.size
+
+    def write_directory(self, updated, dry_run=False):
+        """
+        Write the metadata of all the files to a file, in a single write
+        :param updated: file object
+        :param dry_run:
+        :return:
+        """
+        location = updated.tell()
+        directory = bytearray()
+        for file in self.files:
+            directory += file.pack_metadata(updated, location + len(directory))
+        if not dry_run:
+            updated.write(directory)
 
     def adjust_metaoff_displace(self, direction=1):
         """
@@ -280,26 +424,20 @@ class Pacfile:
 
     def load_compression_info(self, binfile):
         """
-        For each file in the directory, ask it to load its compression info.
+        For each file in the directory, ask it to load its compression info; the files are visited in
+        order of offset, so that the .pac is read front to back.
         After the function terminates, the seek location is unspecified
         :param binfile: file object
         :return:
         """
-        for f in self.files:
-            if f.compressed:
-                f.load_compression_info(binfile)
+        for f in sorted(self.files, key=lambda file: file.offset):
+            f.need_compression_info(binfile)
 
     def get_file_by_id(self, fid):
-        for f in self.files:
-            if f.id == fid:
-                return f
-        return None
+        return self._index()[0].get(fid)
 
     def list_file_ids(self):
-        ids = []
-        for f in self.files:
-            ids.append(f.id)
-        return ids
+        return [f.id for f in self.files]
 
     def list_file_names(self):
         return map(attrgetter("name"), self.files)
@@ -322,46 +460,81 @@ class Pacfile:
         fullpath = self.create_destination(fid, destination)
         file.dump_myself(fullpath, binfile)
 
-    def extract_file_id(self, fid, destination, binfile, debuggy=False):
+    def extract_file_id(self, fid, destination, binfile, debuggy=False, parallel=False):
         """ it's the actual file to decide if run decompres, based on metadata """
         file = self.get_file_by_id(fid)
         fullpath = self.create_destination(fid, destination)
-        file.extract_myself(fullpath, binfile, debuggy=debuggy)
+        file.extract_myself(fullpath, binfile, debuggy=debuggy, parallel=parallel)
+
+    def open(self, fid, binfile):
+        """
+        :param fid: file id (integer)
+        :param binfile: file object
+        :return: seekable file-like object, reading the (uncompressed) file content
+        """
+        return self.get_file_by_id(fid).open(binfile)
 
     def append_file(self, file, start_id=0):
         """
         Add a new file to (the bottom of) the file list contained in this object.
         All the offsets are also re-calculated
         """
-        self.rollback_metaoff_displace()
-        if len(self.files) > 0:
-            file.id = max(self.list_file_ids()) + 1
-        else:
-            file.id = start_id
-        self.files.append(file)
-        self.header.nfiles += 1
-        self.metadata_offset = self.theorize_metadata_offset()
-        self.adjust_metaoff_displace()
+        self.update_files(added=[file], start_id=start_id)
 
     def remove_file(self, file):
         """
         Remove a file from the file list contained in this object.
         All the offsets are also re-calculated
         """
-        if file in self.files:
-            self.rollback_metaoff_displace()
-            self.files.remove(file)
-            self.header.nfiles -= 1
-            self.metadata_offset = self.theorize_metadata_offset()
-            self.adjust_metaoff_displace()
-            self.refreshFileIDs()
+        self.update_files(removed=[file])
+
+    def update_files(self, removed=(), added=(), start_id=0, binfile=None):
+        """
+        Remove and add many files in one go: ids and offsets are re-calculated just once, at the end.
+        If anything was removed, the remaining files are renumbered starting from start_id; the added ones
+        are then given the ids following the highest one (start_id, if the list is empty)
+        :param removed: FileEntry objects to remove (those not in the list are ignored)
+        :param added: FileEntry objects to append to the bottom of the list
+        :param binfile: file object of the .pac the files were loaded from: the compression info not loaded
+         yet are read from it, before the offsets stop matching its content; the seek location is unspecified
+        """
+        removed = set(removed)
+        added = list(added)
+        kept = self.files
+        if len(removed) > 0:
+            kept = [file for file in self.files if file not in removed]
+        if len(kept) == len(self.files) and len(added) == 0:
+            return
+        if binfile is not None:
+            for file in sorted(kept, key=lambda file: file.offset):
+                file.need_compression_info(binfile)
+        self.rollback_metaoff_displace()
+        if len(kept) < len(self.files):
+            self.header.nfiles -= len(self.files) - len(kept)
+            self.files = kept
+            self.refreshFileIDs(start_id=start_id)
+        by_id, by_name = self._index()
+        for file in added:
+            if len(self.files) > 0:
+                file.id = self._max_id + 1
+            else:
+                file.id = start_id
+            self.files.append(file)
+            by_id[file.id] = file
+            by_name.setdefault(file.name, []).append(file)
+            self._max_id = file.id
+        self._sorted = None
+        self.header.nfiles += len(added)
+        self.metadata_offset = self.theorize_metadata_offset()
+        self.adjust_metaoff_displace()
 
     def refreshFileIDs(self, start_id=0):
-        for file in self.files:
-            file.id = self.files.index(file) + start_id  # make sure ids are still consistent
+        for i, file in enumerate(self.files):
+            file.id = i + start_id  # make sure ids are still consistent
+        self._invalidate_index()
 
     def sort_files(self, start_id=0):
-        self.files = sorted(self.files, key=customsort.cmp_to_key(customsort.asciicompare))
+        self.files = sorted(self.files, key=lambda file: customsort.asciikey(file.name))
         self.refreshFileIDs(start_id=start_id)
 
     def preWriteFixHeader(self):
@@ -384,32 +557,87 @@ class Pacfile:
         :param abort:
         :return:
         """
-        with open(filename, "wb") as updatedversion:
-            self.header.write_metadata(updatedversion, dry_run=dry_run)
-            for file in self.files:
-                file.write_out_metadata(updatedversion, dry_run=dry_run)
-            for file in self.files:
-                file.write_out_data(original, updatedversion, self.metadata_offset, dry_run=dry_run, debuggy=debuggy)
-                if progresscback is not None:
-                    progresscback(file)
-                if abort is not None:
-                    if abort():
-                        break
+        # a single pool of workers compresses the chunks of every imported file: they are all queued
+        # upfront, in directory order, so that small files don't leave the workers idle while waiting
+        # for the writer. A background thread collects the results into a bounded queue, which the
+        # writer (this thread) consumes in order: compression keeps going while the writer is busy
+        # copying the unchanged files
+        compressing = [file for file in self.files if file.import_from != "" and file.compressed]
+        threads = None
+        collector = None
+        spill_dir = None
+        if len(compressing) > 0:
+            total_chunks = sum(file.compr_object.chunk_num for file in compressing)
+            lookahead = self.compression_lookahead * getMaxThreads()
+            threads = Broker(total_chunks, debugmode=debuggy, greed=1, lookahead=lookahead)
+            # the workers hand the compressed data over through files, the results only carry their names
+            spill_dir = compression.spill_directory(threads, filename)
+            collector = Prefetcher(threads, total_chunks, lookahead)
+        stop_feeding = Event()
+
+        def spawnAll(filelist):
+            for file in filelist:
+                if not file.compr_object.spawnChunks(file.import_from, threads, debuggy=debuggy, stop=stop_feeding,
+                                                     spill_dir=spill_dir):
+                    break
+
+        feeder = Thread(target=spawnAll, args=(compressing,))
+        try:
+            if threads is not None:
+                feeder.start()
+            with open(filename, "wb") as updatedversion:
+                # runs of unchanged files are copied all at once
+                copier = None
+                if original is not None:
+                    copier = datamover.RangeCopier(original, updatedversion)
+                self.header.write_metadata(updatedversion, dry_run=dry_run)
+                self.write_directory(updatedversion, dry_run=dry_run)
+                for file in self.files:
+                    file.write_out_data(original, updatedversion, self.metadata_offset, dry_run=dry_run,
+                                        debuggy=debuggy, threads=collector, queued=True, copier=copier)
+                    if progresscback is not None:
+                        progresscback(file)
+                    if abort is not None:
+                        if abort():
+                            break
+                if copier is not None:
+                    copier.flush()
+            self._sorted = None  # the compressed sizes may have changed
+        finally:
+            if threads is not None:
+                stop_feeding.set()
+                collector.stop()
+                threads.discard()  # unblock the feeder, if it's waiting for the writer
+                feeder.join()
+                threads.stop()
+                compression.remove_spill_directory(spill_dir)
 
     def search_file(self, name, exact_match=True, adjust_separator=True):
         """ :return: list of file ids """
         ret = []
         if adjust_separator:
             name = adjust_separator_for_pac(name)
-        for file in self.files:
-            if exact_match:
-                if file.name == name:
-                    ret.append(file.id)
-            else:
-                if file.name.startswith(name):
-                    ret.append(file.id)
+        if exact_match:
+            return [file.id for file in self._index()[1].get(name, [])]
+        lo, hi = self._prefix_range(name)
+        for position in sorted(self._sorted_index()[1][lo:hi]):  # keep the directory order
+            ret.append(self.files[position].id)
         return ret
 
+    def folder_size(self, folder, adjust_separator=True):
+        """
+        Aggregate info about the content of a folder (and its subfolders)
+        :param folder: folder name, "" means the whole package
+        :return: number of files, total size, total size inside the .pac (i.e. compressed)
+        """
+        if adjust_separator:
+            folder = adjust_separator_for_pac(folder)
+        if folder != "" and not folder.endswith("\\"):
+            folder += "\\"
+        names, order, sizes, stored_sizes = self._sorted_index()
+        lo, hi = self._prefix_range(folder)
+        return hi - lo, sizes[hi] - sizes[lo], stored_sizes[hi] - stored_sizes[lo]
+
     def print_info(self):
         print("Metadata size: %06x" % (self.metadata_offset,))
         self.header.print_info()
@@ -0,0 +1,110 @@
+from threading import local
+
+from ovsylib import datamover
+from ovsylib.aggressive_threading import Broker, settings
+
+
+"""
+    Extraction of many files at once: each worker receives the package directory (and opens the
+    .pac file) only once, when it starts; afterwards, the jobs carry nothing but file ids
+"""
+
+
+_worker = local()  # set in each worker by init_worker; thread-local, since the workers may be threads
+
+
+def init_worker(pac, filename, destination, mapped=False, debuggy=False, shared=None):
+    """ :param shared: MappedFile of filename, opened by the parent: thread workers just take a cursor on it """
+    _worker.package = pac
+    if shared is not None:
+        _worker.binfile = shared.cursor()
+    else:
+        _worker.binfile = datamover.open_binfile(filename, mapped=mapped)
+    _worker.destination = destination
+    _worker.debuggy = debuggy
+
+
+def extract_ids(fids):
+    """ :return: the ids of the extracted files """
+    for fid in fids:
+        _worker.package.extract_file_id(fid, _worker.destination, _worker.binfile, debuggy=_worker.debuggy)
+    return fids
+
+
+def plan(pac, fids, policy="largest", small_size=0x10000, batch_size=0x100000, max_batch=64):
+    """
+    Group the files into extraction jobs
+    :param pac: Pacfile object
+    :param fids: ids of the files to extract
+    :param policy: "largest": biggest files first (longest processing time first), so that a huge file found at
+     the end of the directory doesn't keep a single worker busy while the others are idle;
+     "offset": in the same order as the data inside the .pac, for sequential reads;
+     "directory": in the given order
+    :param small_size: files smaller than this (in bytes) are extracted together, in jobs of about batch_size bytes
+    :param batch_size:
+    :param max_batch: max number of files in a job
+    :return: list of lists of file ids
+    """
+    files = [pac.get_file_by_id(fid) for fid in fids]
+    if policy == "largest":
+        files.sort(key=lambda file: file.size, reverse=True)
+    elif policy == "offset":
+        files.sort(key=lambda file: file.offset)
+    elif policy != "directory":
+        raise ValueError("unknown extraction policy: %s" % policy)
+    jobs = []
+    batch = []
+    batched_size = 0
+    for file in files:
+        if file.size >= small_size:
+            jobs.append([file.id])
+            continue
+        batch.append(file.id)
+        batched_size += file.size
+        if batched_size >= batch_size or len(batch) >= max_batch:
+            jobs.append(batch)
+            batch = []
+            batched_size = 0
+    if len(batch) > 0:
+        jobs.append(batch)
+    return jobs
+
+
+class Extractor:
+
+    def __init__(self, pac, filename, destination, max_needed_threads=None, mapped=False, debuggy=False):
+        """
+        :param pac: Pacfile object
+        :param filename: .pac file containing the data described by pac
+        :param destination: folder to extract the files into
+        :param max_needed_threads: defaults to the number of files in pac
+        :param mapped: memory-map the .pac file instead of reading it
+        """
+        if max_needed_threads is None:
+            max_needed_threads = len(pac.files)
+        executor = settings["executor"]
+        self.shared = None
+        if mapped and executor != "process":  # same address space: a single mapping for all the workers
+            self.shared = datamover.MappedFile(filename)
+        self.threads = Broker(max(1, max_needed_threads), debugmode=debuggy, initializer=init_worker,
+                              initargs=(pac, filename, destination, mapped, debuggy, self.shared),
+                              executor=executor)
+
+    def submit(self, fids):
+        """ launch the extraction of a batch of files
+        :return: true upon success """
+        return self.threads.appendNfire(extract_ids, (list(fids),))
+
+    def stop(self):
+        """ wait for the launched extractions to complete """
+        self.threads.stop()
+        self.close_shared()
+
+    def abort(self):
+        self.threads.abort()
+        self.close_shared()
+
+    def close_shared(self):
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
@@ -25,38 +25,85 @@ def listrecursive(root, wholedir=False):
 
 class staging:
 
-    def __init__(self):
-        self.package = datastruct.Pacfile()
+    """
+    The staging environment is saved on disk as a journal: a sequence of pickled records, each one describing
+    a change (see _apply). Saving only appends the changes made since the last save, loading replays them all
+    """
+
+    def __init__(self, journaled=False):
+        """
+        :param journaled: record the changes, to be saved by saveEnviron (the command line does so after each
+         operation); otherwise saveEnviron writes a snapshot of the whole environment
+        """
+        self.journaled = journaled
+        self._package = None
         self.target = ""
         self.start_id = 0
+        self.saved_start_id = 0  # start_id as recorded in the journal
         self.deletes = []
         self.appends = []
+        self.journal = []  # pickled records not yet saved to disk
         if os.path.isfile(environ_name):
             self.loadEnviron()
             print("Loaded staging environment from disk")
 
+    @property
+    def package(self):
+        """ the target's directory is loaded only when someone needs it """
+        if self._package is None:
+            self._package = datastruct.Pacfile()
+            if self.target != "":
+                with open(self.target, "rb") as binfile:
+                    self._package.load_from_file(binfile)
+        return self._package
+
+    def _record(self, record):
+        """ apply a change, and append it to the journal; the record is pickled right away, because
+        the objects it refers to may be modified by the later changes """
+        result = self._apply(record)
+        if self.journaled:
+            self.journal.append(pickle.dumps(record))
+        return result
+
+    def _apply(self, record):
+        if isinstance(record, list):  # whole environment, as saved by older versions
+            self._package, self.target, self.start_id, self.appends, self.deletes = record
+            self.saved_start_id = self.start_id
+        elif record[0] == "target":
+            self._package = None
+            self.target = record[1]
+            self.start_id = self.saved_start_id = record[2]
+        elif record[0] == "start_id":
+            self.start_id = self.saved_start_id = record[1]
+        elif record[0] == "add":
+            newfile = record[1]
+            collisions = self.package.search_file(newfile.name)
+            if len(collisions) == 1:
+                self.deletes.append(self.package.get_file_by_id(collisions[0]))  # stage delete old
+            self.appends.append(newfile)  # stage append new
+        elif record[0] == "undo":
+            return self._undo(record[1])
+        elif record[0] == "remove":
+            return self._remove(record[1])
+        elif record[0] == "commit":
+            self._commit()
+
     def loadPackage(self, path):
         with open(path, "rb") as binfile:
-            self.target = path
-            self.package.load_from_file(binfile)
-            self.start_id = min(self.package.list_file_ids())
+            package = datastruct.Pacfile()
+            package.load_from_file(binfile)
+        self._record(("target", path, min(package.list_file_ids())))
+        self._package = package
 
     def addfile(self, internal_name, path, compression=True):
         collisions = self.package.search_file(internal_name)
-        if len(collisions) == 0:
-            newfile = datastruct.FileEntry()
-            newfile.create_from_file(internal_name, path, compress=compression)
-            self.appends.append(newfile)
-            return True
-        elif len(collisions) == 1:
-            self.deletes.append(self.package.get_file_by_id(collisions[0]))  # stage delete old
-            newfile = datastruct.FileEntry()
-            newfile.create_from_file(internal_name, path, compress=compression)
-            self.appends.append(newfile)  # stage append new
-            return False
-        else:
+        if len(collisions) > 1:
             print("Directory consisteny error")  # cryptic error message
-            pass # error
+            return  # error
+        newfile = datastruct.FileEntry()
+        newfile.create_from_file(internal_name, path, compress=compression)
+        self._record(("add", newfile))
+        return len(collisions) == 0
 
     def addDirectory(self, dirpath, verbose=False, compression=True, wholedir=False):
         addenda = listrecursive(dirpath, wholedir=wholedir)
@@ -68,6 +115,9 @@ class staging:
                 print(fs + " will replace " + pac)
 
     def undoFile(self, name):
+        return self._record(("undo", name))
+
+    def _undo(self, name):
         modified = False
         for add in self.appends:
             if add.name == name:
@@ -80,6 +130,9 @@ class staging:
         return modified
 
     def removeFile(self, name):
+        return self._record(("remove", name))
+
+    def _remove(self, name):
         modif = False
         for add in self.appends:
             if add.name == name:
@@ -93,13 +146,18 @@ class staging:
         return modif
 
     def commit(self):
-        for dele in self.deletes:
-            self.package.remove_file(dele)
-        for add in self.appends:
-            self.package.append_file(add, start_id=self.start_id)
-        self.package.sort_files(start_id=self.start_id)
         if len(self.deletes) + len(self.appends) == 0:
             print("Nothing to do")
+        self._record(("commit",))
+
+    def _commit(self):
+        if self.target != "":
+            with open(self.target, "rb") as binfile:  # the offsets are about to change
+                self.package.update_files(removed=self.deletes, added=self.appends, start_id=self.start_id,
+                                          binfile=binfile)
+        else:
+            self.package.update_files(removed=self.deletes, added=self.appends, start_id=self.start_id)
+        self.package.sort_files(start_id=self.start_id)
         self.deletes = []
         self.appends = []
 
@@ -162,16 +220,36 @@ class staging:
         for op in self.listStagedDelete():
             print("delete: " + op)
 
+    def written(self, destination):
+        """ the package has been written to destination, which becomes the new target: the recorded changes
+        are part of it now """
+        self.target = destination
+        self.journal = []
+
     def saveEnviron(self):
-        pickle.dump([self.package, self.target, self.start_id, self.appends, self.deletes], open(environ_name, "wb"))
+        """ append the changes made since the last save to the journal on disk """
+        if not self.journaled:  # nothing recorded, start the journal over from the current state
+            with open(environ_name, "wb") as environ:
+                pickle.dump([self.package, self.target, self.start_id, self.appends, self.deletes], environ)
+            self.saved_start_id = self.start_id
+            return
+        if self.start_id != self.saved_start_id:  # set directly by the caller
+            self.journal.append(pickle.dumps(("start_id", self.start_id)))
+            self.saved_start_id = self.start_id
+        with open(environ_name, "ab") as environ:
+            for record in self.journal:
+                environ.write(record)
+        self.journal = []
 
     def loadEnviron(self):
-        data = pickle.load(open(environ_name, "rb"))
-        self.package = data[0]
-        self.target = data[1]
-        self.start_id = data[2]
-        self.appends = data[3]
-        self.deletes = data[4]
+        with open(environ_name, "rb") as environ:
+            while True:
+                try:
+                    record = pickle.load(environ)
+                except EOFError:
+                    break
+                self._apply(record)
+        self.journal = []
 
     def clearEnviron(self):
         os.remove(environ_name)
@@ -0,0 +1,143 @@
+"""
+    Sidecar index of a .pac file (saved as <filename>.ovsidx, next to it).
+
+    It holds a compact copy of the directory and of the compression headers, so that opening the same
+    package again needs neither to parse the directory nor to seek around for the chunk tables: each entry
+    keeps its chunk tables (FileEntry.compr_tables), and the compression objects are built from them on first use.
+    The index is keyed by the size, mtime and header checksum of the .pac: a stale one is rebuilt.
+    Building it means reading the compression header of every compressed file once (in one front-to-back
+    pass over the .pac), so the first open of a package with many compressed files is slower than a plain one.
+
+    layout (little endian, no padding):
+    [header] [nfiles entry records] [names, latin-1, back to back] [chunk sub-headers, see Algo1.subheader]
+
+"""
+
+import os
+import mmap
+import struct
+import zlib
+
+from ovsylib import compression
+from ovsylib.datastruct import Header, FileEntry
+
+
+suffix = ".ovsidx"
+magic = b"OVSYIDX1"
+# magic, .pac size, .pac mtime (ns), .pac header crc32, nfiles, length of the names, total chunks
+header = struct.Struct("<8sQqIIII")
+# id, compressed size, size, compressed, offset (relative to the data area), name start, name length,
+# compression info cached, then the Chuunicomp header (zeros if not cached)
+entry = struct.Struct("<12I")
+
+
+def index_name(filename):
+    return filename + suffix
+
+
+def package_key(binfile, filename):
+    """ :return: (size, mtime, crc32 of the .pac header) tuple; seek is left after the .pac header """
+    stat = os.stat(filename)
+    binfile.seek(0)
+    return stat.st_size, stat.st_mtime_ns, zlib.crc32(binfile.read(Header.record.size))
+
+
+def load(pac, binfile, filename, eager=False):
+    """
+    Initialize a fresh Pacfile object like Pacfile.load_from_file does, but taking the directory from the
+    sidecar index; if it is missing or stale, the package is parsed as usual and the index (re)built.
+    After the function terminates, the seek location is unspecified
+    :param pac: Pacfile object
+    :param binfile: file object, the opened filename
+    :param filename: path of the .pac file
+    :param eager: also load the compression info of every file
+    :return: True if the index was up to date
+    """
+    key = package_key(binfile, filename)
+    binfile.seek(0)
+    pac.header.load_metadata(binfile)
+    try:
+        with open(index_name(filename), "rb") as indexfile, \
+                mmap.mmap(indexfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            files = read_entries(mapped, key, pac.header.nfiles)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        files = None
+    if files is None:
+        binfile.seek(0)
+        pac.load_from_file(binfile, eager=True)  # the index has room for everything, fill it up
+        write(pac, filename, key)
+        return False
+    pac.files = files
+    pac._invalidate_index()
+    pac.metadata_offset = pac.theorize_metadata_offset()
+    pac.adjust_metaoff_displace()
+    if eager:  # from the chunk tables, plus whatever the index couldn't hold (e.g. bad magic sequences)
+        pac.load_compression_info(binfile)
+    return True
+
+
+def read_entries(mapped, key, nfiles):
+    """
+    :param mapped: buffer holding the whole index
+    :param key: as returned by package_key
+    :param nfiles: number of files, according to the .pac header
+    :return: list of FileEntry objects (offsets relative to the data area), or None if the index is stale
+    """
+    fields = header.unpack_from(mapped, 0)
+    names_start = header.size + entry.size * nfiles
+    chunks_start = names_start + fields[5]
+    if fields[0] != magic or fields[1:4] != key or fields[4] != nfiles or \
+            chunks_start + compression.Algo1.subheader.size * fields[6] != len(mapped):
+        return None
+    names = mapped[names_start:chunks_start].decode("latin-1")
+    files = []
+    for record in entry.iter_unpack(mapped[header.size:names_start]):
+        newfile = FileEntry()
+        newfile.id, newfile.comp_size, newfile.size = record[0:3]
+        newfile.compressed = record[3] != 0
+        newfile.offset = record[4]
+        newfile.name = names[record[5]:record[5] + record[6]]
+        if record[7] != 0:
+            chunks_end = chunks_start + compression.Algo1.subheader.size * record[9]
+            newfile.compr_tables = (record[8:12], bytes(mapped[chunks_start:chunks_end]))
+            chunks_start = chunks_end
+        files.append(newfile)
+    return files
+
+
+def write(pac, filename, key):
+    """
+    Save the index of a freshly loaded Pacfile; failing to do so (e.g. read-only directory) is not an error
+    :param key: as returned by package_key
+    :return: True if the index was written
+    """
+    entries = bytearray()
+    names = bytearray()
+    chunks = bytearray()
+    nchunks = 0
+    for file in pac.files:
+        name = file.name.encode("latin-1")
+        compr = file.compr_object
+        if compr is not None and compr.magicseq == 0x1234:
+            cached = (1, compr.magicseq, compr.chunk_num, compr.chunksize, compr.header_size)
+            for chunk in compr.chunks:
+                chunks += compression.Algo1.subheader.pack(chunk.uncomp_size, chunk.comp_size, chunk.rootaddress)
+            nchunks += len(compr.chunks)
+        else:
+            cached = (0, 0, 0, 0, 0)
+        entries += entry.pack(file.id, file.comp_size, file.size, int(file.compressed),
+                              file.offset - pac.metadata_offset, len(names), len(name), *cached)
+        names += name
+    temp = index_name(filename) + ".tmp"
+    try:
+        with open(temp, "wb") as indexfile:
+            indexfile.write(header.pack(magic, key[0], key[1], key[2], len(pac.files), len(names), nchunks))
+            indexfile.write(entries)
+            indexfile.write(names)
+            indexfile.write(chunks)
+        os.replace(temp, index_name(filename))
+    except OSError:
+        if os.path.isfile(temp):
+            os.remove(temp)
+        return False
+    return True
@@ -1,4 +1,22 @@
-import struct
+def unpack_string(raw):
+    """
+    Decode an ascii string from a 0x00-padded bytes object
+
+    :param raw: bytes object
+    :return: ascii string (stops at the first 0x00 byte)
+    """
+    return raw.split(b"\0", 1)[0].decode("latin-1")
+
+
+def pack_string(length, text):
+    """
+    Encode an ascii string into a fixed length bytes object
+
+    :param length: number of bytes; if the string is shorter, the length is padded with 0x00 bytes
+    :param text: ascii string
+    :return: bytes object
+    """
+    return text.encode("ascii")[:length].ljust(length, b"\0")
 
 
 def get_string(binfile, length):
@@ -9,18 +27,7 @@ def get_string(binfile, length):
     :param length: number of bytes
     :return: ascii string
     """
-    ret = ""
-    read = 0
-    for i in range(length):
-        char = struct.unpack("B", binfile.read(1))[0]
-        if char != 0:
-            ret = ret + chr(char)
-        else:
-            read = i + 1
-            break
-    if read < length:
-        binfile.seek(length - read, 1)
-    return ret
+    return unpack_string(binfile.read(length))
 
 
 def put_string(binfile, length, text):
@@ -31,8 +38,4 @@ def put_string(binfile, length, text):
     :param length: number of bytes; if the string is shorter, the length is padded with 0x00 bytes
     :param text: ascii string
     """
-    for i in range(length):
-        if i < len(text):
-            binfile.write(struct.pack("c", text[i].encode("ascii")))
-        else:
-            binfile.write(struct.pack("B", 0))
+    binfile.write(pack_string(length, text))
@@ -0,0 +1,12 @@
+def restore_slots(obj, state):
+    """
+    __setstate__ for classes using __slots__, which also accepts the plain __dict__ pickled before
+    the class got its __slots__ (e.g. by an old staging environment)
+
+    :param obj: object being unpickled
+    :param state: either a (None, slots dict) pair, or a dict
+    """
+    if isinstance(state, tuple):
+        state = state[1]
+    for key, value in state.items():
+        setattr(obj, key, value)